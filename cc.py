@@ -1,18 +1,523 @@
+import io
 import os
+import re
+import json
+import time
 import asyncio
-from PIL import Image
+import shutil
+import uuid
+import random
+import hashlib
+import tempfile
+import itertools
+import contextlib
+import contextvars
+from collections import defaultdict, deque
+from PIL import Image, ImageOps
 from pyrogram import Client, filters, enums
+from pyrogram.errors import FloodWait
 from utils.misc import modules_help, prefix
 from utils.scripts import format_exc, import_library
 from utils.config import gemini_key
+from utils.db import db
 
-genai = import_library("google.genai", "google-genai")
-client = genai.Client(api_key=gemini_key)
+genai = None
+_genai_lock = asyncio.Lock()
 
+NS = "custom.cc"
+GCHAT_SETTINGS = "custom.gsettings"
+MB = 1024 * 1024
 MODEL_NAME = "gemini-2.5-flash"
 COOK_GEN_CONFIG = {
     "temperature": 0.35, "top_p": 0.95, "top_k": 40, "max_output_tokens": 1024
 }
+DEFAULT_SETTINGS = {
+    "engine": "async",
+    "max_concurrency": 8,
+    "upload_cache": True,
+    "upload_cache_size": 100,
+    "stream": True,
+    "stream_edit_interval": 1.5,
+    "inline_image_bytes": 4 * MB,
+    "inline_audio_bytes": 2 * MB,
+    "upload_deadline": 180,
+    "in_memory": True,
+    "memory_max_bytes": 20 * MB,
+    "max_image_jobs": 6,
+    "max_audio_jobs": 3,
+    "max_video_jobs": 2,
+    "max_document_jobs": 3,
+    "answer_cache": True,
+    "answer_cache_size": 200,
+    "answer_cache_ttl": 7 * 24 * 3600,
+    "answer_cache_max_chars": 20000,
+    "image_max_edge": 1536,
+    "image_format": "jpeg",
+    "image_quality": 85,
+    "long_audio": True,
+    "long_audio_seconds": 900,
+    "segment_seconds": 300,
+    "segment_overlap": 3,
+    "segment_workers": 4,
+    "segment_retries": 2,
+    "silence_db": -30,
+    "video_frames": False,
+    "frame_interval": 2.0,
+    "max_frames": 32,
+    "frame_edge": 768,
+    "frame_dedupe_bits": 6,
+    "max_batch": 20,
+    "local_text": True,
+    "local_text_max_bytes": 20 * MB,
+    "local_text_max_chars": 500000,
+    "text_chunk_chars": 30000,
+    "pdf_min_chars_per_page": 100,
+    "gc_batch": 10,
+    "gc_interval": 5.0,
+    "gc_orphan_age": 6 * 3600,
+    "max_chunk_messages": 3,
+    "preview_chars": 800,
+    "document_format": "md",
+    "retry_attempts": 4,
+    "retry_base_delay": 1.0,
+    "retry_max_delay": 30.0,
+    "breaker_threshold": 5,
+    "breaker_cooldown": 30.0,
+    "key_rpm": 10,
+    "key_cooldown": 60.0,
+    "model": MODEL_NAME,
+    "preflight": False,
+    "max_input_tokens": 900000,
+    "output_budgets": True,
+    "thinking_budget": 1024,
+    "warmup": True,
+    "warmup_delay": 30.0,
+    "quick_look": True,
+    "quick_look_edge": 640,
+    "stream_upload": True,
+    "stream_upload_min_bytes": 20 * MB,
+    "stream_upload_chunk_bytes": 8 * MB,
+    "stream_upload_read_ahead": 8,
+}
+DEFAULT_ROUTES = [
+    {"model": "gemini-2.5-flash-lite", "commands": ["getai"], "kinds": ["image"], "max_size": 2 * MB, "max_prompt": 200},
+]
+THINKING_MODELS = ("gemini-2.5",)
+MAX_OUTPUT_TOKENS = 65536
+OUTPUT_BUDGETS = {"getai": 1536, "aiseller": 1536, "aicook": 2048, "process": 4096, "pr": 4096}
+SPEECH_TOKENS_PER_SECOND = 6
+MEDIA_TOKENS_PER_SECOND = {"video": 300, "audio": 32}
+IMAGE_TOKENS = 1290
+PDF_BYTES_PER_PAGE = 100 * 1024
+PDF_TOKENS_PER_PAGE = 258
+SNIFF_BYTES = 256
+PHASE_SAMPLES = 1000
+PHASES = ("queue", "download", "stream", "upload", "poll", "generate", "send", "total")
+STAT_DIMENSIONS = ("command", "kind", "model")
+SUPPORTED_MIMES = {
+    "image": {"image/jpeg", "image/png", "image/webp"},
+    "audio": {"audio/wav", "audio/mpeg", "audio/aiff", "audio/aac", "audio/ogg", "audio/flac"},
+    "video": {"video/mp4", "video/mpeg", "video/quicktime", "video/avi", "video/x-flv", "video/webm", "video/wmv", "video/3gpp"},
+}
+BINARY_MAGIC = {
+    b"PK\x03\x04": "application/zip",
+    b"Rar!": "application/vnd.rar",
+    b"7z\xbc\xaf": "application/x-7z-compressed",
+    b"\x1f\x8b": "application/gzip",
+    b"MZ": "application/x-msdownload",
+    b"\x7fELF": "application/x-elf",
+    b"\xd0\xcf\x11\xe0": "application/x-ole-storage",
+}
+ROUTE_LIMITS = ("min_duration", "max_duration", "min_size", "max_size", "max_prompt")
+MESSAGE_LIMIT = 4000
+CAPTION_LIMIT = 1000
+POLL_MIN_DELAY = 0.25
+POLL_MAX_DELAY = 5.0
+POLL_BACKOFF = 1.6
+POLL_EMA_WEIGHT = 0.3
+DEFAULT_POLL_RATES = {"image": 0.3, "audio": 0.5, "video": 2.0, "PDF": 1.0, "document": 0.5}
+FLAGS = ("nocache", "full", "long", "frames", "quick", "detail")
+QUICK_LOOK_COMMANDS = {"getai"}
+DETAIL_HINTS = re.compile(r"\b(?:read|text|details?|zoom|small|tiny|count|exact|numbers?|ocr|written|labels?|fine print)\b", re.IGNORECASE)
+GETAI_PROMPT = "Get details of the image, be accurate as much possible, write short response."
+AUDIO_HINTS = ("say", "said", "speak", "spoke", "talk", "audio", "sound", "music", "song", "lyric", "hear", "voice", "transcri", "conversation", "dialog")
+STITCH_WINDOW = 40
+TEXT_EXTENSIONS = {
+    ".txt", ".md", ".rst", ".log", ".csv", ".tsv", ".json", ".jsonl", ".xml", ".html", ".htm",
+    ".yaml", ".yml", ".toml", ".ini", ".cfg", ".conf", ".env", ".srt", ".vtt", ".sql",
+    ".py", ".js", ".ts", ".jsx", ".tsx", ".java", ".kt", ".c", ".h", ".cpp", ".hpp", ".cs",
+    ".go", ".rs", ".rb", ".php", ".swift", ".sh", ".bat", ".ps1", ".lua", ".dart", ".css",
+}
+EXIF_ORIENTATION = 0x0112
+HEIF_MIMES = {"image/heic", "image/heif"}
+MP4_BRANDS = {b"isom", b"iso2", b"iso4", b"iso5", b"iso6", b"mp41", b"mp42", b"avc1", b"dash", b"MSNV", b"f4v "}
+IMAGE_FORMATS = {"jpeg": "image/jpeg", "webp": "image/webp"}
+JOB_GROUPS = {"image": "image", "audio": "audio", "video": "video", "PDF": "document", "document": "document"}
+UPLOAD_TAG = "cc-"
+ERROR_PATTERNS = (
+    ("rate_limit", re.compile(r"\b(?:429|quota|resource_exhausted|rate limit)\b")),
+    ("unavailable", re.compile(r"\b(?:50[0234]|unavailable|overloaded|deadline exceeded|timed out)\b")),
+    ("permission", re.compile(r"\b(?:403|permission denied)\b")),
+)
+UPLOAD_ENDPOINT = "https://generativelanguage.googleapis.com"
+UPLOAD_GRANULE = 256 * 1024
+STREAM_KINDS = {"video", "audio", "document", "PDF"}
+UPLOAD_TTL = 47 * 3600
+UPLOAD_EXPIRY_MARGIN = 3600
+_flood = {"until": 0.0}
+_heif = {"registered": False}
+route_latency = defaultdict(lambda: deque(maxlen=200))
+active_jobs = {}
+live_uploads = defaultdict(int)
+_deferred_deletes = {}
+_job_ids = itertools.count(1)
+phase_stats = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: {"samples": deque(maxlen=PHASE_SAMPLES), "errors": 0})))
+_job_labels = contextvars.ContextVar("cc_job_labels", default=None)
+_current_lease = contextvars.ContextVar("cc_key_lease", default=None)
+gc_queue = asyncio.Queue()
+gc_worker_started = False
+
+def get_setting(key):
+    return db.get(NS, key, DEFAULT_SETTINGS[key])
+
+def set_setting(key, raw):
+    default = DEFAULT_SETTINGS[key]
+    if isinstance(default, bool):
+        value = raw.lower() in {"1", "on", "true", "yes"}
+    elif isinstance(default, (int, float)):
+        value = type(default)(raw)
+    else:
+        value = raw
+    db.set(NS, key, value)
+    return value
+
+@contextlib.contextmanager
+def _phase(name):
+    labels = _job_labels.get()
+    started = time.monotonic()
+    try:
+        yield
+    except Exception:
+        _record_phase(labels, name, None)
+        raise
+    else:
+        _record_phase(labels, name, time.monotonic() - started)
+
+def _record_phase(labels, name, elapsed):
+    if not labels:
+        return
+    for dimension, value in labels.items():
+        stats = phase_stats[dimension][value][name]
+        if elapsed is None:
+            stats["errors"] += 1
+        else:
+            stats["samples"].append(elapsed)
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class JobScheduler:
+    def __init__(self):
+        self.waiting = []
+        self.running = defaultdict(int)
+        self.owners = defaultdict(int)
+        self.total = 0
+        self._seq = itertools.count()
+
+    def _order(self, waiter):
+        return (self.owners[waiter["owner"]], waiter["size"], waiter["seq"])
+
+    def position(self, waiter):
+        return sorted(self.waiting, key=self._order).index(waiter) + 1
+
+    def _dispatch(self):
+        global_limit = max(1, int(get_setting("max_concurrency")))
+        for waiter in sorted(self.waiting, key=self._order):
+            if self.total >= global_limit:
+                break
+            group = waiter["group"]
+            if self.running[group] >= max(1, int(get_setting(f"max_{group}_jobs"))):
+                continue
+            self.waiting.remove(waiter)
+            self.running[group] += 1
+            self.owners[waiter["owner"]] += 1
+            self.total += 1
+            waiter["granted"] = True
+            waiter["event"].set()
+        for waiter in self.waiting:
+            waiter["event"].set()
+
+    def _release(self, waiter):
+        self.running[waiter["group"]] -= 1
+        self.owners[waiter["owner"]] -= 1
+        self.total -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, kind, size, owner, on_queue=None):
+        waiter = {
+            "group": JOB_GROUPS[kind], "size": size, "owner": owner,
+            "seq": next(self._seq), "event": asyncio.Event(), "granted": False,
+        }
+        self.waiting.append(waiter)
+        self._dispatch()
+        try:
+            shown = None
+            while not waiter["granted"]:
+                position = self.position(waiter)
+                if on_queue and position != shown:
+                    shown = position
+                    await on_queue(position)
+                await waiter["event"].wait()
+                waiter["event"].clear()
+        except BaseException:
+            if waiter["granted"]:
+                self._release(waiter)
+            else:
+                self.waiting.remove(waiter)
+                self._dispatch()
+            raise
+        try:
+            yield shown is not None
+        finally:
+            self._release(waiter)
+
+scheduler = JobScheduler()
+
+class CircuitOpenError(ValueError):
+    pass
+
+def _classify(error):
+    if isinstance(error, ValueError):
+        return "fatal"
+    code = getattr(error, "code", None)
+    if not isinstance(code, int):
+        code = getattr(getattr(error, "response", None), "status_code", None)
+    status = str(getattr(error, "status", "") or "").upper()
+    msg = str(error).lower()
+    if "mimetype parameter" in msg and "not supported" in msg:
+        return "unsupported"
+    if code == 429 or status == "RESOURCE_EXHAUSTED":
+        return "rate_limit"
+    if code in {500, 502, 503, 504} or status in {"UNAVAILABLE", "INTERNAL", "DEADLINE_EXCEEDED"}:
+        return "unavailable"
+    if code == 403 or status == "PERMISSION_DENIED":
+        return "permission"
+    if isinstance(code, int) or status:
+        return "fatal"
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return "unavailable"
+    for outcome, pattern in ERROR_PATTERNS:
+        if pattern.search(msg):
+            return outcome
+    return "fatal"
+
+def _retry_hint(error):
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    value = headers.get("retry-after") if hasattr(headers, "get") else None
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    text = json.dumps(getattr(error, "details", None), default=str) + str(error)
+    match = re.search(r"retry(?:Delay|[ _-]?after|\s+in)[\"':\s]*([\d.]+)\s*(ms|s)?", text, re.I)
+    if not match:
+        return None
+    seconds = float(match.group(1))
+    return seconds / 1000 if match.group(2) == "ms" else seconds
+
+class RetryPolicy:
+    RETRYABLE = {"rate_limit", "unavailable", "permission"}
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self.cooldown_until = 0.0
+
+    @property
+    def blocked_until(self):
+        return max(self.open_until, self.cooldown_until)
+
+    def _check(self):
+        remaining = self.open_until - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpenError(f"Gemini is saturated, try again in {remaining:.0f}s")
+
+    def _trip(self, hint):
+        self.failures += 1
+        if self.failures >= int(get_setting("breaker_threshold")):
+            cooldown = max(float(get_setting("breaker_cooldown")), hint or 0)
+            self.open_until = time.monotonic() + cooldown
+
+    async def call(self, func):
+        attempts = max(1, int(get_setting("retry_attempts")))
+        max_delay = float(get_setting("retry_max_delay"))
+        for attempt in range(attempts):
+            self._check()
+            try:
+                result = await func()
+            except Exception as e:
+                kind = _classify(e)
+                if kind not in self.RETRYABLE:
+                    raise
+                hint = _retry_hint(e)
+                if kind == "rate_limit":
+                    self.cooldown_until = time.monotonic() + (hint or float(get_setting("key_cooldown")))
+                if kind != "permission":
+                    self._trip(hint)
+                if attempt == attempts - 1 or (hint or 0) > max_delay:
+                    raise
+                base = float(get_setting("retry_base_delay"))
+                await asyncio.sleep(hint if hint is not None else random.uniform(0, min(max_delay, base * 2 ** attempt)))
+            else:
+                self.failures = 0
+                return result
+
+def _load_genai():
+    global genai
+    if genai is None:
+        genai = import_library("google.genai", "google-genai")
+    return genai
+
+async def ensure_genai():
+    if genai is None:
+        async with _genai_lock:
+            if genai is None:
+                await asyncio.to_thread(_load_genai)
+    return genai
+
+async def warm_up():
+    await asyncio.sleep(float(get_setting("warmup_delay")))
+    try:
+        await ensure_genai()
+        key_pool.all()
+        ensure_gc_worker()
+    except Exception:
+        pass
+
+def schedule_warm_up():
+    if not get_setting("warmup"):
+        return
+    try:
+        asyncio.get_running_loop().create_task(warm_up())
+    except RuntimeError:
+        pass
+
+class KeyPool:
+    def __init__(self):
+        self.leases = {}
+
+    def _lease_for(self, api_key):
+        key_id = hashlib.sha256(api_key.encode()).hexdigest()[:12]
+        if key_id not in self.leases:
+            self.leases[key_id] = {
+                "id": key_id,
+                "client": genai.Client(api_key=api_key),
+                "api_key": api_key,
+                "policy": RetryPolicy(),
+                "in_flight": 0,
+                "calls": deque(),
+            }
+        return self.leases[key_id]
+
+    def all(self):
+        return [self._lease_for(api_key) for api_key in db.get(GCHAT_SETTINGS, "gemini_keys") or [gemini_key]]
+
+    def get(self, key_id):
+        return self.leases.get(key_id)
+
+    def recent_calls(self, lease):
+        cutoff = time.monotonic() - 60
+        while lease["calls"] and lease["calls"][0] < cutoff:
+            lease["calls"].popleft()
+        return len(lease["calls"])
+
+    def pick(self):
+        now = time.monotonic()
+        leases = self.all()
+        ready = [lease for lease in leases if lease["policy"].blocked_until <= now]
+        if not ready:
+            return min(leases, key=lambda lease: lease["policy"].blocked_until)
+        budget = int(get_setting("key_rpm"))
+        return min(ready, key=lambda lease: (
+            budget > 0 and self.recent_calls(lease) >= budget, lease["in_flight"], self.recent_calls(lease)))
+
+    @contextlib.contextmanager
+    def lease(self):
+        lease = self.pick()
+        lease["in_flight"] += 1
+        token = _current_lease.set(lease)
+        try:
+            yield lease
+        finally:
+            lease["in_flight"] -= 1
+            _current_lease.reset(token)
+
+key_pool = KeyPool()
+
+def _lease():
+    return _current_lease.get() or key_pool.all()[0]
+
+def _api():
+    lease = _lease()
+    lease["calls"].append(time.monotonic())
+    return lease["client"]
+
+def _use_aio():
+    return get_setting("engine") == "async" and hasattr(_lease()["client"], "aio")
+
+async def _files_upload(**kwargs):
+    async def attempt():
+        if hasattr(kwargs["file"], "seek"):
+            kwargs["file"].seek(0)
+        if _use_aio():
+            return await _api().aio.files.upload(**kwargs)
+        return await asyncio.to_thread(_api().files.upload, **kwargs)
+    return await _lease()["policy"].call(attempt)
+
+async def _files_get(name):
+    async def attempt():
+        if _use_aio():
+            return await _api().aio.files.get(name=name)
+        return await asyncio.to_thread(_api().files.get, name=name)
+    return await _lease()["policy"].call(attempt)
+
+async def _files_list():
+    if _use_aio():
+        return [item async for item in await _api().aio.files.list()]
+    api = _api()
+    return await asyncio.to_thread(lambda: list(api.files.list()))
+
+async def _files_delete(name):
+    if _use_aio():
+        return await _api().aio.files.delete(name=name)
+    return await asyncio.to_thread(_api().files.delete, name=name)
+
+async def _generate(**kwargs):
+    async def attempt():
+        if _use_aio():
+            return await _api().aio.models.generate_content(**kwargs)
+        return await asyncio.to_thread(_api().models.generate_content, **kwargs)
+    with _phase("generate"):
+        return await _lease()["policy"].call(attempt)
+
+async def _count_tokens(**kwargs):
+    async def attempt():
+        if _use_aio():
+            return await _api().aio.models.count_tokens(**kwargs)
+        return await asyncio.to_thread(_api().models.count_tokens, **kwargs)
+    return await _lease()["policy"].call(attempt)
+
+async def _generate_stream(**kwargs):
+    if _use_aio():
+        async for chunk in await _api().aio.models.generate_content_stream(**kwargs):
+            yield chunk
+        return
+    iterator = iter(await asyncio.to_thread(_api().models.generate_content_stream, **kwargs))
+    done = object()
+    while (chunk := await asyncio.to_thread(next, iterator, done)) is not done:
+        yield chunk
 
 def _valid_file(reply, file_type=None):
     if file_type == "image":
@@ -28,39 +533,1103 @@ def _valid_file(reply, file_type=None):
         or getattr(reply, "document", None)
     )
 
-async def _upload_file(file_path, file_type):
-    uploaded = await asyncio.to_thread(client.files.upload, file=file_path)
-    for _ in range(120):
+def _poll_estimate(file_type, size):
+    rates = db.get(NS, "poll_rates", {}) or {}
+    rate = rates.get(file_type, DEFAULT_POLL_RATES.get(file_type, 0.5))
+    return rate * max(size / MB, 1)
+
+def _record_poll(file_type, size, elapsed):
+    rates = db.get(NS, "poll_rates", {}) or {}
+    observed = elapsed / max(size / MB, 1)
+    previous = rates.get(file_type, DEFAULT_POLL_RATES.get(file_type, observed))
+    rates[file_type] = previous + POLL_EMA_WEIGHT * (observed - previous)
+    db.set(NS, "poll_rates", rates)
+
+async def _upload_file(source, file_type, mime_type=None):
+    size = _source_size(source)
+    config = {"display_name": f"{UPLOAD_TAG}{uuid.uuid4().hex}"}
+    if mime_type:
+        config["mime_type"] = mime_type
+    with _phase("upload"):
+        uploaded = await _files_upload(file=source, config=config)
+    with _phase("poll"):
+        return await _wait_active(uploaded, file_type, size)
+
+def _use_stream_upload(reply, kind):
+    size = getattr(_media(reply), "file_size", None) or 0
+    if not get_setting("stream_upload") or kind not in STREAM_KINDS or size < get_setting("stream_upload_min_bytes"):
+        return False
+    return not (kind in {"document", "PDF"} and get_setting("local_text") and size <= get_setting("local_text_max_bytes"))
+
+async def _stream_upload(reply, kind, job):
+    size = _media(reply).file_size
+    chunks = (job.get("app") or reply._client).stream_media(reply)
+    with _phase("download"):
+        try:
+            head = await chunks.__anext__()
+        except StopAsyncIteration:
+            raise ValueError("Failed to process the file. Try again.")
+    mime_type = _sniff(head[:SNIFF_BYTES])
+    if mime_type and kind in {"document", "PDF"}:
+        kind = _kind_for(mime_type)
+    if not mime_type or not (mime_type == "application/pdf" or mime_type in SUPPORTED_MIMES.get(kind, ())):
+        await chunks.aclose()
+        if mime_type is None and kind in {"document", "PDF"} and not _looks_like_text(head[:SNIFF_BYTES]):
+            raise ValueError("Unsupported file type")
+        if mime_type and kind is None:
+            raise ValueError(f"Unsupported file type: {mime_type}")
+        if mime_type and kind in {"audio", "video"} and not shutil.which("ffmpeg"):
+            raise ValueError(f"Unsupported {kind} format: {mime_type}")
+        return None
+
+    read_ahead = asyncio.Queue(maxsize=int(get_setting("stream_upload_read_ahead")))
+
+    async def produce():
+        try:
+            async for chunk in chunks:
+                await read_ahead.put(chunk)
+            await read_ahead.put(None)
+        except Exception as e:
+            await read_ahead.put(e)
+
+    producer = asyncio.create_task(produce())
+    try:
+        with _phase("stream"):
+            uploaded, sha256 = await _resumable_upload(read_ahead, head, size, mime_type)
+    finally:
+        producer.cancel()
+    with _phase("poll"):
+        return kind, await _wait_active(uploaded, kind, size), sha256
+
+async def _resumable_upload(read_ahead, head, size, mime_type):
+    httpx = import_library("httpx")
+    lease = _lease()
+    auth = {"x-goog-api-key": lease["api_key"]}
+    chunk_bytes = max(int(get_setting("stream_upload_chunk_bytes")) // UPLOAD_GRANULE, 1) * UPLOAD_GRANULE
+    digest = hashlib.sha256(head)
+    buffer = bytearray(head)
+    offset = 0
+
+    async with httpx.AsyncClient(timeout=float(get_setting("upload_deadline"))) as http:
+        async def start():
+            lease["calls"].append(time.monotonic())
+            response = await http.post(f"{UPLOAD_ENDPOINT}/upload/v1beta/files", headers={
+                **auth,
+                "X-Goog-Upload-Protocol": "resumable",
+                "X-Goog-Upload-Command": "start",
+                "X-Goog-Upload-Header-Content-Length": str(size),
+                "X-Goog-Upload-Header-Content-Type": mime_type,
+            }, json={"file": {"display_name": f"{UPLOAD_TAG}{uuid.uuid4().hex}"}})
+            response.raise_for_status()
+            return response.headers["x-goog-upload-url"]
+
+        url = await lease["policy"].call(start)
+
+        async def send(data, final):
+            nonlocal offset
+            attempts = int(get_setting("retry_attempts"))
+            for attempt in range(attempts + 1):
+                try:
+                    response = await http.post(url, content=bytes(data), headers={
+                        **auth,
+                        "X-Goog-Upload-Command": "upload, finalize" if final else "upload",
+                        "X-Goog-Upload-Offset": str(offset),
+                    })
+                    response.raise_for_status()
+                    offset += len(data)
+                    return response
+                except httpx.HTTPError as e:
+                    if attempt == attempts or _classify(e) not in {"unavailable", "rate_limit"}:
+                        raise
+                await asyncio.sleep(random.uniform(0, min(float(get_setting("retry_max_delay")), float(get_setting("retry_base_delay")) * 2 ** attempt)))
+                status = await http.post(url, headers={**auth, "X-Goog-Upload-Command": "query"})
+                received = int(status.headers.get("x-goog-upload-size-received", offset))
+                data, offset = data[received - offset:], received
+
+        while True:
+            chunk = await read_ahead.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if chunk is None:
+                break
+            digest.update(chunk)
+            buffer += chunk
+            ready = (len(buffer) - 1) // UPLOAD_GRANULE * UPLOAD_GRANULE
+            if ready >= chunk_bytes:
+                await send(buffer[:ready], final=False)
+                del buffer[:ready]
+        response = await send(buffer, final=True)
+
+    return genai.types.File.model_validate(response.json()["file"]), digest.hexdigest()
+
+async def _wait_active(uploaded, file_type, size):
+    started = time.monotonic()
+    deadline = started + float(get_setting("upload_deadline"))
+    delay = min(max(_poll_estimate(file_type, size), POLL_MIN_DELAY), POLL_MAX_DELAY)
+    while True:
         state = getattr(uploaded, "state", None)
         name = getattr(uploaded, "name", None) or getattr(uploaded, "id", None)
         if state and getattr(state, "name", "").upper() == "ACTIVE":
+            _record_poll(file_type, size, time.monotonic() - started)
             return uploaded
         if state and getattr(state, "name", "").upper() == "FAILED":
             raise ValueError(f"{file_type.capitalize()} failed to process")
-        if name:
-            try:
-                uploaded = await asyncio.to_thread(client.files.get, name=name)
-            except Exception:
-                pass
-        await asyncio.sleep(1)
-    raise ValueError(f"{file_type.capitalize()} upload timed out")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise ValueError(f"{file_type.capitalize()} upload timed out")
+        try:
+            await asyncio.sleep(min(delay, remaining))
+            if name:
+                try:
+                    uploaded = await _files_get(name)
+                except CircuitOpenError:
+                    raise
+                except Exception:
+                    pass
+        except asyncio.CancelledError:
+            if name:
+                await _delete_quietly(name)
+            raise
+        delay = min(delay * POLL_BACKOFF, POLL_MAX_DELAY)
+
+def _media(reply):
+    return (
+        reply.photo or reply.video or reply.video_note
+        or reply.audio or reply.voice or reply.document
+    )
 
-async def prepare_input_data(reply, file_path, prompt):
+def _media_key(reply):
+    return getattr(_media(reply), "file_unique_id", None)
+
+def _media_variant(reply, kind, flags):
+    unique_id = _media_key(reply)
+    thumb = _pick_thumb(reply) if "quick" in flags else None
+    if unique_id and thumb:
+        return f"{unique_id}:thumb{thumb.file_unique_id}"
+    if unique_id and kind == "image" and "full" not in flags:
+        return f"{unique_id}:{get_setting('image_format')}{get_setting('image_max_edge')}q{get_setting('image_quality')}"
+    if unique_id and _use_frames(reply, flags):
+        return f"{unique_id}:frames{get_setting('frame_interval')}x{get_setting('max_frames')}"
+    return unique_id
+
+def _pick_thumb(reply):
+    media = reply.photo or reply.video or reply.video_note
+    thumbs = [thumb for thumb in (getattr(media, "thumbs", None) or []) if thumb.width and thumb.height]
+    if not thumbs:
+        return None
     if reply.photo:
-        with Image.open(file_path) as img:
-            img.verify()
-        return [prompt, await _upload_file(file_path, "image")]
+        edge = int(get_setting("quick_look_edge"))
+        adequate = [thumb for thumb in thumbs if max(thumb.width, thumb.height) >= edge]
+        return min(adequate, key=lambda thumb: thumb.width * thumb.height) if adequate else None
+    return max(thumbs, key=lambda thumb: thumb.width * thumb.height)
+
+def _wants_quick_look(command, reply, prompt, flags, app):
+    if app is None or flags & {"full", "detail"} or (prompt != GETAI_PROMPT and DETAIL_HINTS.search(prompt)):
+        return False
+    if "quick" in flags:
+        return True
+    return bool(reply.photo) and get_setting("quick_look") and command in QUICK_LOOK_COMMANDS
+
+def _media_mime(reply, kind):
+    if kind == "image":
+        return "image/jpeg"
+    return getattr(_media(reply), "mime_type", None)
+
+def _media_kind(reply):
+    if reply.photo:
+        return "image"
     if reply.video or reply.video_note:
-        return [prompt, await _upload_file(file_path, "video")]
+        return "video"
     if reply.audio or reply.voice:
-        return [await _upload_file(file_path, "audio"), prompt]
-    if reply.document and file_path.endswith(".pdf"):
-        return [prompt, await _upload_file(file_path, "PDF")]
+        return "audio"
     if reply.document:
-        return [await _upload_file(file_path, "document"), prompt]
+        file_name = (getattr(reply.document, "file_name", None) or "").lower()
+        if file_name.endswith(".pdf") or getattr(reply.document, "mime_type", None) == "application/pdf":
+            return "PDF"
+        return "document"
     raise ValueError("Unsupported file type")
 
-async def ai_process_handler(message, prompt, show_prompt=False, cook_mode=False, expect_type=None, status_msg="Processing..."):
+def _arrange(kind, parts, prompt):
+    if kind in {"audio", "document"}:
+        return [*parts, prompt]
+    return [prompt, *parts]
+
+def _file_sha256(source):
+    if not isinstance(source, str):
+        return hashlib.sha256(source.getbuffer()).hexdigest()
+    digest = hashlib.sha256()
+    with open(source, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _upload_cache():
+    now = time.time()
+    cache = db.get(NS, "upload_cache", {}) or {}
+    return {key: entry for key, entry in cache.items() if entry.get("expires", 0) > now}
+
+def _cache_lookup(unique_id, sha256=None):
+    cache = _upload_cache()
+    key_id = _lease()["id"]
+    entry = cache.get(unique_id) if unique_id else None
+    if entry is not None and entry.get("key") != key_id:
+        entry = None
+    if entry is None and sha256:
+        entry = next((dict(e) for e in cache.values() if e.get("sha256") == sha256 and e.get("key") == key_id), None)
+    if entry is None:
+        return None
+    if unique_id:
+        entry["used"] = time.time()
+        cache[unique_id] = entry
+        db.set(NS, "upload_cache", cache)
+    return entry
+
+def _cache_store(unique_id, sha256, uploaded):
+    cache = _upload_cache()
+    expires = getattr(uploaded, "expiration_time", None)
+    evicted = [cache[unique_id]] if unique_id in cache else []
+    cache[unique_id] = {
+        "key": _lease()["id"],
+        "name": uploaded.name,
+        "uri": uploaded.uri,
+        "mime_type": uploaded.mime_type,
+        "sha256": sha256,
+        "expires": expires.timestamp() - UPLOAD_EXPIRY_MARGIN if expires else time.time() + UPLOAD_TTL,
+        "used": time.time(),
+    }
+    while len(cache) > max(1, int(get_setting("upload_cache_size"))):
+        oldest = min(cache, key=lambda key: cache[key]["used"])
+        evicted.append(cache.pop(oldest))
+    db.set(NS, "upload_cache", cache)
+    live_names = {entry["name"] for entry in cache.values()}
+    for entry in evicted:
+        lease = key_pool.get(entry.get("key"))
+        if entry["name"] in live_names or not lease:
+            continue
+        if live_uploads.get(entry["name"]):
+            _deferred_deletes[entry["name"]] = lease
+        else:
+            queue_delete(entry["name"], lease)
+
+def _hold_upload(job, name):
+    live_uploads[name] += 1
+    job["held"].append(name)
+
+def _release_uploads(job):
+    for name in job["held"]:
+        live_uploads[name] -= 1
+        if live_uploads[name] <= 0:
+            del live_uploads[name]
+            if name in _deferred_deletes:
+                queue_delete(name, _deferred_deletes.pop(name))
+    job["held"] = []
+
+def _cache_drop(unique_id):
+    cache = _upload_cache()
+    if cache.pop(unique_id, None) is not None:
+        db.set(NS, "upload_cache", cache)
+
+def _cached_part(entry):
+    return genai.types.Part.from_uri(file_uri=entry["uri"], mime_type=entry["mime_type"])
+
+def _inline_limit(kind):
+    if kind == "image":
+        return get_setting("inline_image_bytes")
+    if kind == "audio":
+        return get_setting("inline_audio_bytes")
+    return 0
+
+def _flatten(img):
+    if img.mode in {"RGBA", "LA"} or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    return img.convert("RGB")
+
+def _normalize_image(source, mime_type):
+    image_format = get_setting("image_format")
+    if image_format not in IMAGE_FORMATS:
+        image_format = "jpeg"
+    max_edge = int(get_setting("image_max_edge"))
+    with Image.open(source) as img:
+        rotated = img.getexif().get(EXIF_ORIENTATION, 1) != 1
+        img = _flatten(ImageOps.exif_transpose(img))
+        resized = max(img.size) > max_edge
+        if resized:
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, format=image_format.upper(), quality=int(get_setting("image_quality")), optimize=True)
+    if not isinstance(source, str):
+        source.seek(0)
+    if not resized and not rotated and buffer.getbuffer().nbytes >= _source_size(source):
+        return source, mime_type
+    buffer.seek(0)
+    return buffer, IMAGE_FORMATS[image_format]
+
+def _source_size(source):
+    if isinstance(source, str):
+        return os.path.getsize(source)
+    return source.getbuffer().nbytes
+
+def _read_bytes(source):
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            return f.read()
+    return source.getvalue()
+
+async def _download(reply, kind, job):
+    size = getattr(_media(reply), "file_size", None) or 0
+    if get_setting("in_memory") and _media_mime(reply, kind) and 0 < size <= get_setting("memory_max_bytes"):
+        with _phase("download"):
+            buffer = await reply.download(in_memory=True)
+        if buffer:
+            buffer.seek(0)
+            return buffer
+    with _phase("download"):
+        file_path = await reply.download()
+    if not file_path or not os.path.exists(file_path):
+        raise ValueError("Failed to process the file. Try again.")
+    job["files"].append(file_path)
+    return file_path
+
+async def _delete_quietly(name, lease=None):
+    if lease:
+        _current_lease.set(lease)
+    try:
+        await _files_delete(name)
+    except Exception:
+        pass
+
+async def _sweep_orphans(lease):
+    _current_lease.set(lease)
+    live_names = {entry["name"] for entry in _upload_cache().values() if entry.get("key") == lease["id"]}
+    cutoff = time.time() - float(get_setting("gc_orphan_age"))
+    try:
+        files = await _files_list()
+    except Exception:
+        return
+    for item in files:
+        created = getattr(item, "create_time", None)
+        if (
+            (getattr(item, "display_name", None) or "").startswith(UPLOAD_TAG)
+            and item.name not in live_names
+            and created and created.timestamp() < cutoff
+        ):
+            gc_queue.put_nowait((item.name, lease))
+
+async def gc_worker():
+    await asyncio.gather(*(_sweep_orphans(lease) for lease in key_pool.all()))
+    while True:
+        items = [await gc_queue.get()]
+        deadline = time.monotonic() + float(get_setting("gc_interval"))
+        while len(items) < int(get_setting("gc_batch")):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(gc_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        unique = {(name, lease["id"]): lease for name, lease in items}
+        await asyncio.gather(*(_delete_quietly(name, lease) for (name, _), lease in unique.items()))
+
+def ensure_gc_worker():
+    global gc_worker_started
+    if not gc_worker_started:
+        asyncio.create_task(gc_worker())
+        gc_worker_started = True
+
+def queue_delete(name, lease=None):
+    if name:
+        ensure_gc_worker()
+        gc_queue.put_nowait((name, lease or _lease()))
+
+def _pdf_text(data):
+    pypdf = import_library("pypdf")
+    reader = pypdf.PdfReader(io.BytesIO(data))
+    pages = [page.extract_text() or "" for page in reader.pages]
+    text = "\n\n".join(page.strip() for page in pages if page.strip())
+    if len(text) < len(pages) * get_setting("pdf_min_chars_per_page"):
+        return None
+    return text
+
+def _extract_text(source, kind, file_name, mime_type):
+    data = _read_bytes(source)
+    if kind == "PDF":
+        try:
+            text = _pdf_text(data)
+        except Exception:
+            return None
+    else:
+        extension = os.path.splitext(file_name.lower())[1]
+        if extension not in TEXT_EXTENSIONS and not (mime_type or "").startswith("text/"):
+            return None
+        if b"\x00" in data[:8192]:
+            return None
+        try:
+            text = data.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            return None
+    if not text or len(text) > get_setting("local_text_max_chars"):
+        return None
+    return text
+
+def _text_parts(text, file_name):
+    size = max(1000, int(get_setting("text_chunk_chars")))
+    chunks = []
+    while text:
+        cut = len(text) if len(text) <= size else (text.rfind("\n", 0, size) + 1 or size)
+        chunks.append(text[:cut])
+        text = text[cut:]
+    if len(chunks) == 1:
+        return [f"File {file_name}:\n{chunks[0]}"]
+    return [f"File {file_name} (part {i} of {len(chunks)}):\n{chunk}" for i, chunk in enumerate(chunks, 1)]
+
+def _read_head(source):
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            return f.read(SNIFF_BYTES)
+    return bytes(source.getbuffer()[:SNIFF_BYTES])
+
+def _sniff(head):
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"GIF8"):
+        return "image/gif"
+    if head.startswith(b"RIFF"):
+        return {b"WEBP": "image/webp", b"WAVE": "audio/wav", b"AVI ": "video/avi"}.get(head[8:12])
+    if head[4:8] == b"ftyp":
+        brand = head[8:12]
+        if brand in {b"heic", b"heix", b"hevc", b"heim", b"heis", b"hevm", b"hevs"}:
+            return "image/heic"
+        if brand in {b"mif1", b"msf1"}:
+            return "image/heif"
+        if brand in {b"M4A ", b"M4B "}:
+            return "audio/mp4"
+        if brand == b"qt  ":
+            return "video/quicktime"
+        if brand.startswith(b"3g"):
+            return "video/3gpp"
+        if brand in {b"avif", b"avis"}:
+            return "image/avif"
+        if brand in MP4_BRANDS:
+            return "video/mp4"
+        return None
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return "video/webm" if b"webm" in head else "video/x-matroska"
+    if head.startswith(b"OggS"):
+        return "audio/ogg"
+    if head.startswith(b"fLaC"):
+        return "audio/flac"
+    if head.startswith(b"ID3") or head[:2] in {b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"}:
+        return "audio/mpeg"
+    if head[:2] in {b"\xff\xf1", b"\xff\xf9"}:
+        return "audio/aac"
+    if head.startswith(b"#!AMR"):
+        return "audio/amr"
+    if head.startswith(b"FORM") and head[8:12] in {b"AIFF", b"AIFC"}:
+        return "audio/aiff"
+    if head.startswith(b"%PDF"):
+        return "application/pdf"
+    for magic, mime in BINARY_MAGIC.items():
+        if head.startswith(magic):
+            return mime
+    return None
+
+def _looks_like_text(head):
+    if b"\x00" in head:
+        return False
+    try:
+        head.decode("utf-8")
+    except UnicodeDecodeError as e:
+        return e.start >= len(head) - 3
+    return True
+
+def _kind_for(mime_type):
+    if mime_type == "application/pdf":
+        return "PDF"
+    return mime_type.split("/")[0] if mime_type.split("/")[0] in {"image", "audio", "video"} else None
+
+def _source_path(source, job):
+    if isinstance(source, str):
+        return source
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(source.getbuffer())
+    job["files"].append(f.name)
+    return f.name
+
+def _register_heif():
+    if _heif["registered"]:
+        return
+    _heif["registered"] = True
+    try:
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+    except ImportError:
+        pass
+
+def _convert_image(source, heif=False):
+    if heif:
+        _register_heif()
+    with Image.open(source) as img:
+        buffer = io.BytesIO()
+        _flatten(ImageOps.exif_transpose(img)).save(buffer, format="JPEG", quality=90)
+    buffer.seek(0)
+    return buffer
+
+async def _sniff_and_fix(source, kind, mime_type, job):
+    head = await asyncio.to_thread(_read_head, source)
+    sniffed = _sniff(head)
+    if sniffed is None:
+        if kind not in {"document", "PDF"}:
+            return source, kind, mime_type
+        if not _looks_like_text(head):
+            raise ValueError("Unsupported file type")
+        return source, "document", "text/plain"
+    if kind in {"document", "PDF"}:
+        kind = _kind_for(sniffed)
+        if kind is None:
+            raise ValueError(f"Unsupported file type: {sniffed}")
+    if kind == "image" and sniffed not in SUPPORTED_MIMES["image"] | HEIF_MIMES:
+        try:
+            return await asyncio.to_thread(_convert_image, source), kind, "image/jpeg"
+        except (OSError, ValueError):
+            raise ValueError(f"Unsupported image format: {sniffed}")
+    if kind == "image" and sniffed in HEIF_MIMES:
+        try:
+            return await asyncio.to_thread(_convert_image, source, True), kind, "image/jpeg"
+        except Exception:
+            return source, kind, sniffed
+    if kind in {"audio", "video"} and sniffed not in SUPPORTED_MIMES[kind]:
+        if not shutil.which("ffmpeg"):
+            raise ValueError(f"Unsupported {kind} format: {sniffed}")
+        file_path = _source_path(source, job)
+        if kind == "audio":
+            data, _ = await _ffmpeg("-i", file_path, "-vn", "-c:a", "aac", "-b:a", "96k", "-f", "adts", "pipe:1")
+            return io.BytesIO(data), kind, "audio/aac"
+        mp4 = ("-f", "mp4", "-movflags", "frag_keyframe+empty_moov", "pipe:1")
+        try:
+            data, _ = await _ffmpeg("-i", file_path, "-c", "copy", *mp4)
+        except ValueError:
+            data, _ = await _ffmpeg("-i", file_path, "-c:v", "mpeg4", "-q:v", "5", "-c:a", "aac", *mp4)
+        return io.BytesIO(data), kind, "video/mp4"
+    return source, kind, sniffed
+
+async def _prepare_part(reply, job):
+    kind = _media_kind(reply)
+    unique_id = _media_variant(reply, kind, job["flags"])
+    use_cache = get_setting("upload_cache") and unique_id
+    if use_cache:
+        entry = _cache_lookup(unique_id)
+        if entry:
+            job["cached"].append(unique_id)
+            _hold_upload(job, entry["name"])
+            return kind, [_cached_part(entry)]
+
+    thumb = _pick_thumb(reply) if "quick" in job["flags"] else None
+    if thumb:
+        with _phase("download"):
+            buffer = await job["app"].download_media(thumb.file_id, in_memory=True)
+        buffer.seek(0)
+        return "image", [genai.types.Part.from_bytes(data=buffer.getvalue(), mime_type="image/jpeg")]
+
+    if _use_stream_upload(reply, kind):
+        streamed = await _stream_upload(reply, kind, job)
+        if streamed:
+            kind, uploaded, sha256 = streamed
+            if use_cache:
+                _hold_upload(job, uploaded.name)
+                _cache_store(unique_id, sha256, uploaded)
+            else:
+                job["uploads"].append(getattr(uploaded, "name", None) or getattr(uploaded, "id", None))
+            return kind, [uploaded]
+
+    source = await _download(reply, kind, job)
+    source, kind, mime_type = await _sniff_and_fix(source, kind, _media_mime(reply, kind), job)
+    if kind == "image" and mime_type not in HEIF_MIMES:
+        with Image.open(source) as img:
+            img.verify()
+        if not isinstance(source, str):
+            source.seek(0)
+        if "full" not in job["flags"]:
+            source, mime_type = await asyncio.to_thread(_normalize_image, source, mime_type)
+
+    if kind in {"PDF", "document"} and get_setting("local_text") and _source_size(source) <= get_setting("local_text_max_bytes"):
+        file_name = getattr(reply.document, "file_name", None) or "file"
+        text = await asyncio.to_thread(_extract_text, source, kind, file_name, mime_type)
+        if text:
+            return kind, _text_parts(text, file_name)
+
+    if _source_size(source) <= _inline_limit(kind):
+        data = await asyncio.to_thread(_read_bytes, source)
+        return kind, [genai.types.Part.from_bytes(data=data, mime_type=mime_type or "audio/ogg")]
+
+    sha256 = None
+    if use_cache:
+        sha256 = await asyncio.to_thread(_file_sha256, source)
+        entry = _cache_lookup(unique_id, sha256)
+        if entry:
+            _hold_upload(job, entry["name"])
+            return kind, [_cached_part(entry)]
+
+    uploaded = await _upload_file(source, kind, mime_type)
+    if use_cache:
+        _hold_upload(job, uploaded.name)
+        _cache_store(unique_id, sha256, uploaded)
+    else:
+        job["uploads"].append(getattr(uploaded, "name", None) or getattr(uploaded, "id", None))
+    return kind, [uploaded]
+
+async def prepare_input_data(reply, prompt, job):
+    kind, parts = await _prepare_part(reply, job)
+    return _arrange(kind, parts, prompt)
+
+async def _collect_batch(app, message, count):
+    reply = message.reply_to_message
+    if not reply:
+        return None
+    if count:
+        ids = [i for i in range(reply.id, reply.id + min(count, int(get_setting("max_batch")))) if i != message.id]
+        messages = await app.get_messages(message.chat.id, ids)
+    elif reply.media_group_id:
+        messages = await app.get_media_group(message.chat.id, reply.id)
+    else:
+        return None
+    batch = [m for m in messages if m and not getattr(m, "empty", False) and _valid_file(m)]
+    return batch if len(batch) > 1 else None
+
+async def _prepare_batch(batch, prompt, job):
+    tasks = [asyncio.ensure_future(_prepare_part(item, job)) for item in batch]
+    try:
+        prepared = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    note = f"The following {len(prepared)} files are given in order; answer over all of them together."
+    return [prompt, note, *(part for _, parts in prepared for part in parts)]
+
+def _media_duration(reply):
+    return getattr(_media(reply), "duration", None) or 0
+
+def _use_long_audio(reply, show_prompt, expect_type, flags):
+    if not shutil.which("ffmpeg") or _media_kind(reply) not in {"audio", "video"}:
+        return False
+    if "long" in flags:
+        return True
+    return (
+        get_setting("long_audio") and expect_type == "audio" and not show_prompt
+        and _media_duration(reply) >= get_setting("long_audio_seconds")
+    )
+
+async def _ffmpeg(*args):
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-nostdin", *args,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate()
+    log = stderr.decode(errors="ignore")
+    if process.returncode != 0:
+        raise ValueError(f"ffmpeg failed: {log.strip().splitlines()[-1] if log.strip() else process.returncode}")
+    return stdout, log
+
+async def _silence_points(file_path):
+    _, log = await _ffmpeg(
+        "-i", file_path, "-vn", "-af", f"silencedetect=noise={get_setting('silence_db')}dB:d=0.4",
+        "-f", "null", "-",
+    )
+    starts = [float(x) for x in re.findall(r"silence_start: (-?[\d.]+)", log)]
+    ends = [float(x) for x in re.findall(r"silence_end: ([\d.]+)", log)]
+    return [(start + end) / 2 for start, end in zip(starts, ends)]
+
+def _plan_segments(duration, silences, length, overlap):
+    cuts, position = [], 0.0
+    while duration - position > length * 1.25:
+        target = position + length
+        nearby = [point for point in silences if abs(point - target) <= length / 4]
+        position = min(nearby, key=lambda point: abs(point - target)) if nearby else target
+        cuts.append(position)
+    bounds = [0.0] + cuts + [float(duration)]
+    return [(max(0.0, start - overlap), end) for start, end in zip(bounds, bounds[1:])]
+
+async def _extract_segment(file_path, start, end):
+    stdout, _ = await _ffmpeg(
+        "-ss", f"{start:.2f}", "-t", f"{end - start:.2f}", "-i", file_path,
+        "-vn", "-ac", "1", "-ar", "16000", "-c:a", "aac", "-b:a", "48k", "-f", "adts", "pipe:1",
+    )
+    return stdout
+
+async def _transcribe_segment(data, prompt, index, total, job):
+    if len(data) <= _inline_limit("audio"):
+        part = genai.types.Part.from_bytes(data=data, mime_type="audio/aac")
+    else:
+        part = await _upload_file(io.BytesIO(data), "audio", "audio/aac")
+        job["uploads"].append(getattr(part, "name", None) or getattr(part, "id", None))
+    note = f"(Part {index + 1} of {total}; it may start or end mid-sentence.)"
+    config = _gen_config("transcribe", False, "audio", float(get_setting("segment_seconds")), job["model"])
+    response = await _generate(model=job["model"], contents=[part, f"{prompt}\n{note}"], config=config)
+    return _response_text(response) or ""
+
+def _stitch(texts):
+    pieces, tail = [], []
+    for text in texts:
+        words = text.split()
+        overlap = 0
+        for n in range(min(len(tail), len(words), STITCH_WINDOW), 1, -1):
+            if [w.lower() for w in tail[-n:]] == [w.lower() for w in words[:n]]:
+                overlap = n
+                break
+        rest = text.split(None, overlap)[overlap:] if overlap else [text]
+        piece = rest[0].strip() if rest else ""
+        if piece:
+            pieces.append(piece)
+        tail = (tail + words[overlap:])[-STITCH_WINDOW:]
+    return "\n".join(pieces)
+
+async def _transcribe_long(message, reply, prompt, status_msg, job):
+    with _phase("download"):
+        file_path = await reply.download()
+    if not file_path or not os.path.exists(file_path):
+        raise ValueError("Failed to process the file. Try again.")
+    job["files"].append(file_path)
+    silences = await _silence_points(file_path)
+    segments = _plan_segments(
+        _media_duration(reply), silences,
+        float(get_setting("segment_seconds")), float(get_setting("segment_overlap")),
+    )
+    texts = [None] * len(segments)
+    workers = asyncio.Semaphore(max(1, int(get_setting("segment_workers"))))
+    progress = {"done": 0, "shown": 0.0}
+
+    async def run(index):
+        async with workers:
+            data = await _extract_segment(file_path, *segments[index])
+            texts[index] = await _transcribe_segment(data, prompt, index, len(segments), job)
+        progress["done"] += 1
+        if time.monotonic() - progress["shown"] >= float(get_setting("stream_edit_interval")):
+            progress["shown"] = time.monotonic()
+            try:
+                await message.edit_text(f"<code>{status_msg} ({progress['done']}/{len(segments)} segments)</code>")
+            except Exception:
+                pass
+
+    pending = list(range(len(segments)))
+    for _ in range(int(get_setting("segment_retries")) + 1):
+        results = await asyncio.gather(*(run(index) for index in pending), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        pending = [index for index, result in zip(pending, results) if isinstance(result, Exception)]
+        if not pending:
+            break
+    else:
+        raise ValueError(f"{len(pending)} of {len(segments)} segments failed: {errors[0]}")
+    return _stitch(texts)
+
+def _use_frames(reply, flags):
+    if not (reply.video or reply.video_note) or not shutil.which("ffmpeg"):
+        return False
+    return "frames" in flags or get_setting("video_frames")
+
+def _split_jpegs(stream):
+    starts = [match.start() for match in re.finditer(b"\xff\xd8\xff", stream)]
+    return [stream[start:end] for start, end in zip(starts, starts[1:] + [len(stream)])]
+
+def _frame_hash(data):
+    with Image.open(io.BytesIO(data)) as img:
+        pixels = list(img.convert("L").resize((8, 8)).getdata())
+    mean = sum(pixels) / len(pixels)
+    return sum(1 << i for i, pixel in enumerate(pixels) if pixel > mean)
+
+def _dedupe_frames(frames):
+    kept, last = [], None
+    threshold = int(get_setting("frame_dedupe_bits"))
+    for frame in frames:
+        frame_hash = _frame_hash(frame)
+        if last is None or bin(frame_hash ^ last).count("1") > threshold:
+            kept.append(frame)
+            last = frame_hash
+    return kept
+
+async def _sample_frames(file_path, duration):
+    max_frames = max(1, int(get_setting("max_frames")))
+    interval = max(float(get_setting("frame_interval")), duration / max_frames if duration else 0)
+    edge = int(get_setting("frame_edge"))
+    stdout, _ = await _ffmpeg(
+        "-i", file_path, "-an",
+        "-vf", f"fps=1/{interval:.3f},scale='min({edge},iw)':-2",
+        "-frames:v", str(max_frames), "-q:v", "4", "-f", "image2pipe", "-c:v", "mjpeg", "pipe:1",
+    )
+    return await asyncio.to_thread(_dedupe_frames, _split_jpegs(stdout))
+
+async def _prepare_frames(reply, prompt, expect_type, job):
+    with _phase("download"):
+        file_path = await reply.download()
+    if not file_path or not os.path.exists(file_path):
+        raise ValueError("Failed to process the file. Try again.")
+    job["files"].append(file_path)
+    duration = _media_duration(reply)
+    frames = await _sample_frames(file_path, duration)
+    if not frames:
+        raise ValueError("Video failed to process")
+    parts = [genai.types.Part.from_bytes(data=frame, mime_type="image/jpeg") for frame in frames]
+    note = f"These are {len(parts)} frames sampled in order from a {duration}s video."
+    if expect_type == "audio" or any(hint in prompt.lower() for hint in AUDIO_HINTS):
+        try:
+            audio = await _extract_segment(file_path, 0, duration or 24 * 3600)
+        except ValueError:
+            audio = None
+        if audio:
+            if len(audio) <= _inline_limit("audio"):
+                parts.append(genai.types.Part.from_bytes(data=audio, mime_type="audio/aac"))
+            else:
+                uploaded = await _upload_file(io.BytesIO(audio), "audio", "audio/aac")
+                job["uploads"].append(getattr(uploaded, "name", None) or getattr(uploaded, "id", None))
+                parts.append(uploaded)
+            note += " The video's audio track follows the frames."
+    return [prompt, note, *parts]
+
+def _split_flags(message):
+    text = message.text.split(maxsplit=1)[1] if len(message.command) > 1 else ""
+    flags = {flag for flag in FLAGS if re.search(rf"(?<!\S)--{flag}(?!\S)", text)}
+    for flag in flags:
+        text = re.sub(rf"(?<!\S)--{flag}(?!\S)", "", text)
+    return text.strip(), flags
+
+def _estimate_text_tokens(text):
+    return len(text) // 4 + 1
+
+def _estimate_media_tokens(reply):
+    kind = _media_kind(reply)
+    size = getattr(_media(reply), "file_size", None) or 0
+    if kind in MEDIA_TOKENS_PER_SECOND:
+        return int(_media_duration(reply) * MEDIA_TOKENS_PER_SECOND[kind])
+    if kind == "image":
+        return IMAGE_TOKENS
+    if kind == "PDF":
+        return max(1, size // PDF_BYTES_PER_PAGE) * PDF_TOKENS_PER_PAGE
+    if reply.document and _is_text_document(reply.document):
+        return size // 4
+    return 0
+
+def _is_text_document(document):
+    file_name = (getattr(document, "file_name", None) or "").lower()
+    mime_type = getattr(document, "mime_type", None) or ""
+    return os.path.splitext(file_name)[1] in TEXT_EXTENSIONS or mime_type.startswith("text/")
+
+async def _input_tokens(model, input_data):
+    if all(isinstance(part, str) for part in input_data):
+        return sum(_estimate_text_tokens(part) for part in input_data)
+    try:
+        result = await _count_tokens(model=model, contents=input_data)
+    except Exception:
+        return 0
+    return getattr(result, "total_tokens", 0) or 0
+
+def _speech_budget(seconds):
+    return max(1024, min(MAX_OUTPUT_TOKENS, int(seconds * SPEECH_TOKENS_PER_SECOND)))
+
+def _gen_config(command, cook_mode, kind, duration, model):
+    config = dict(COOK_GEN_CONFIG) if cook_mode else {}
+    if not get_setting("output_budgets"):
+        return config or None
+    if command in {"transcribe", "ts"} or (kind in MEDIA_TOKENS_PER_SECOND and command not in OUTPUT_BUDGETS):
+        config["max_output_tokens"] = _speech_budget(duration)
+    else:
+        config["max_output_tokens"] = OUTPUT_BUDGETS.get(command, config.get("max_output_tokens", 4096))
+    if model.startswith(THINKING_MODELS) and "lite" in model:
+        config["thinking_config"] = {"thinking_budget": 0}
+    elif model.startswith(THINKING_MODELS):
+        thinking = max(int(get_setting("thinking_budget")), 128 if "pro" in model else 0)
+        config["thinking_config"] = {"thinking_budget": thinking}
+        config["max_output_tokens"] = min(config["max_output_tokens"] + thinking, MAX_OUTPUT_TOKENS)
+    return config
+
+def _answer_key(reply, prompt, cook_mode, flags, model):
+    unique_id = _media_variant(reply, _media_kind(reply), flags)
+    if not unique_id:
+        return None
+    raw = json.dumps([unique_id, prompt, model, COOK_GEN_CONFIG if cook_mode else None], sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def _count_answer(outcome):
+    stats = db.get(NS, "answer_cache_stats", {}) or {}
+    stats[outcome] = stats.get(outcome, 0) + 1
+    db.set(NS, "answer_cache_stats", stats)
+
+def _answer_lookup(key):
+    cache = db.get(NS, "answer_cache", {}) or {}
+    entry = cache.get(key)
+    if entry is None or time.time() - entry["created"] > get_setting("answer_cache_ttl"):
+        _count_answer("misses")
+        return None
+    entry["used"] = time.time()
+    db.set(NS, "answer_cache", cache)
+    _count_answer("hits")
+    return entry["text"]
+
+def _answer_store(key, text_out):
+    if not isinstance(text_out, str) or not text_out or len(text_out) > get_setting("answer_cache_max_chars"):
+        return
+    now = time.time()
+    ttl = get_setting("answer_cache_ttl")
+    cache = db.get(NS, "answer_cache", {}) or {}
+    cache = {k: e for k, e in cache.items() if now - e["created"] <= ttl}
+    cache[key] = {"text": text_out, "created": now, "used": now}
+    while len(cache) > max(1, int(get_setting("answer_cache_size"))):
+        cache.pop(min(cache, key=lambda k: cache[k]["used"]))
+    db.set(NS, "answer_cache", cache)
+
+def _note_flood(seconds):
+    _flood["until"] = max(_flood["until"], time.monotonic() + seconds)
+
+def _flooded():
+    return time.monotonic() < _flood["until"]
+
+def _as_document(result_text):
+    pages = -(-len(result_text) // MESSAGE_LIMIT)
+    return pages > int(get_setting("max_chunk_messages")) or (pages > 1 and _flooded())
+
+async def _send_document(message, result_text, caption):
+    extension = "md" if get_setting("document_format") == "md" else "txt"
+    document = io.BytesIO(result_text.encode())
+    document.name = f"answer.{extension}"
+    try:
+        return await message.reply_document(document, caption=caption, parse_mode=enums.ParseMode.MARKDOWN)
+    except FloodWait as e:
+        _note_flood(e.value)
+        await asyncio.sleep(e.value)
+        document.seek(0)
+        return await message.reply_document(document, caption=caption, parse_mode=enums.ParseMode.MARKDOWN)
+
+def _preview(result_text):
+    limit = min(int(get_setting("preview_chars")), CAPTION_LIMIT)
+    return result_text if len(result_text) <= limit else result_text[:limit].rstrip() + "…"
+
+async def _deliver(message, result_text):
+    with _phase("send"):
+        await _send_result(message, result_text)
+
+async def _send_result(message, result_text):
+    if len(result_text) <= MESSAGE_LIMIT:
+        await message.edit_text(result_text, parse_mode=enums.ParseMode.MARKDOWN)
+    elif _as_document(result_text):
+        await _send_document(message, result_text, _preview(result_text))
+        await message.delete()
+    else:
+        for i in range(0, len(result_text), MESSAGE_LIMIT):
+            try:
+                await message.reply_text(result_text[i:i+MESSAGE_LIMIT], parse_mode=enums.ParseMode.MARKDOWN)
+            except FloodWait as e:
+                _note_flood(e.value)
+                await _send_document(message, result_text, _preview(result_text[i:]))
+                break
+        await message.delete()
+
+def _response_text(response):
+    text_out = getattr(response, "text", None)
+    if not text_out:
+        try:
+            text_out = response.candidates[0].content[0].text
+        except Exception:
+            text_out = None
+    return text_out
+
+async def _edit_page(page_msg, text):
+    try:
+        await page_msg.edit_text(text, parse_mode=enums.ParseMode.MARKDOWN)
+    except FloodWait as e:
+        _note_flood(e.value)
+        return e.value
+    except Exception:
+        pass
+    return 0
+
+async def _stream_answer(message, header, **kwargs):
+    text_out, pages, shown = "", [message], [""]
+    last_edit, pause, overflow = 0.0, 0.0, False
+    interval = float(get_setting("stream_edit_interval"))
+    try:
+        async for chunk in _generate_stream(**kwargs):
+            text_out += getattr(chunk, "text", None) or ""
+            if overflow:
+                continue
+            full = header + "**Answer:** " + text_out
+            while len(full) > len(pages) * MESSAGE_LIMIT:
+                start = (len(pages) - 1) * MESSAGE_LIMIT
+                page = full[start:start + MESSAGE_LIMIT]
+                if len(pages) >= int(get_setting("max_chunk_messages")) or _flooded():
+                    overflow = True
+                    page = page[:MESSAGE_LIMIT - 40] + "\n\n<i>… full answer follows as a file</i>"
+                if page != shown[-1]:
+                    await _edit_page(pages[-1], page)
+                    shown[-1] = page
+                if overflow:
+                    break
+                following = full[start + MESSAGE_LIMIT:start + 2 * MESSAGE_LIMIT]
+                pages.append(await message.reply_text(following, parse_mode=enums.ParseMode.MARKDOWN))
+                shown.append(following)
+                last_edit = time.monotonic()
+            if overflow:
+                continue
+            page = full[(len(pages) - 1) * MESSAGE_LIMIT:]
+            now = time.monotonic()
+            if page != shown[-1] and now - last_edit >= interval + pause:
+                pause = await _edit_page(pages[-1], page)
+                shown[-1], last_edit = page, now
+    except Exception as e:
+        if text_out:
+            raise ValueError(f"Answer stream interrupted: {e}")
+        raise
+    full = header + "**Answer:** " + (text_out or "<code>No content generated.</code>")
+    if overflow:
+        await _send_document(pages[-1], full, "**Full answer**")
+        return text_out
+    page = full[(len(pages) - 1) * MESSAGE_LIMIT:]
+    if page != shown[-1]:
+        if pause:
+            await asyncio.sleep(pause)
+        await _edit_page(pages[-1], page)
+    return text_out
+
+def get_routes():
+    routes = db.get(NS, "routes", None)
+    return DEFAULT_ROUTES if routes is None else routes
+
+def _route(command, kind, duration, size, prompt):
+    for index, rule in enumerate(get_routes(), 1):
+        if rule.get("commands") and command not in rule["commands"]:
+            continue
+        if rule.get("kinds") and kind not in rule["kinds"]:
+            continue
+        if duration > rule.get("max_duration", duration) or duration < rule.get("min_duration", duration):
+            continue
+        if size > rule.get("max_size", size) or size < rule.get("min_size", size):
+            continue
+        if len(prompt) > rule.get("max_prompt", len(prompt)):
+            continue
+        return f"#{index}", rule["model"]
+    return "default", get_setting("model")
+
+def _parse_route(args):
+    rule = {"model": args[0]}
+    for arg in args[1:]:
+        key, _, value = arg.partition("=")
+        if key in {"commands", "kinds"}:
+            rule[key] = [item for item in value.split(",") if item]
+        elif key in ROUTE_LIMITS:
+            rule[key] = int(value)
+        else:
+            raise ValueError(f"Unknown route field: {key}")
+    return rule
+
+def _median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2] if ordered else 0
+
+async def ai_process_handler(message, prompt, show_prompt=False, cook_mode=False, expect_type=None, status_msg="Processing...", flags=(), batch=None, app=None):
     reply = message.reply_to_message
     if not reply:
         usage_hint = f"<b>Usage:</b> <code>{prefix}{message.command[0]} [prompt]</code> [Reply to a file]" if expect_type is None else \
@@ -69,94 +1638,160 @@ async def ai_process_handler(message, prompt, show_prompt=False, cook_mode=False
     if not _valid_file(reply, file_type=expect_type):
         type_text = expect_type if expect_type else "supported"
         return await message.edit_text(f"<code>Invalid {type_text} file. Please try again.</code>")
+
+    command = message.command[0].lower()
+    items = batch or [reply]
+    size = sum(getattr(_media(item), "file_size", None) or 0 for item in items)
+    largest = max(items, key=lambda item: getattr(_media(item), "file_size", None) or 0)
+    route, model = _route(
+        command, _media_kind(largest),
+        max(_media_duration(item) for item in items), size, prompt,
+    )
+
+    flags = set(flags)
+    if not batch and _wants_quick_look(command, reply, prompt, flags, app):
+        flags.add("quick")
+    estimate = sum(_estimate_media_tokens(item) for item in items) + _estimate_text_tokens(prompt)
+    limit = int(get_setting("max_input_tokens"))
+    if estimate > limit:
+        if _media_kind(largest) == "video" and not batch and shutil.which("ffmpeg"):
+            flags.add("frames")
+        elif _media_kind(largest) == "audio" and not batch and shutil.which("ffmpeg"):
+            flags.add("long")
+        else:
+            return await message.edit_text(f"<code>Input is too large (~{estimate} tokens, limit {limit}).</code>")
+    config = _gen_config(command, cook_mode, _media_kind(largest), max(_media_duration(item) for item in items), model)
+
+    answer_key = _answer_key(reply, prompt, cook_mode, flags, model) if get_setting("answer_cache") and not batch else None
+    if answer_key and "nocache" not in flags:
+        text_out = _answer_lookup(answer_key)
+        if text_out:
+            header = f"**Prompt:** {prompt}\n" if show_prompt else ""
+            return await _deliver(message, header + f"**Answer:** {text_out}")
     await message.edit_text(f"<code>{status_msg}</code>")
-    file_path = await reply.download()
-    if not file_path or not os.path.exists(file_path):
-        return await message.edit_text("<code>Failed to process the file. Try again.</code>")
 
-    uploaded_file = None
+    async def show_position(position):
+        try:
+            await message.edit_text(f"<code>{status_msg} (queued, position {position})</code>")
+        except Exception:
+            pass
+
     try:
-        input_data = await prepare_input_data(reply, file_path, prompt)
-        if len(input_data) > 1 and hasattr(input_data[1], "name"):
-            uploaded_file = input_data[1]
+        await ensure_genai()
+    except Exception as e:
+        return await message.edit_text(f"<code>Error:</code> {format_exc(e)}")
 
-        for _ in range(3):
-            try:
-                response = await asyncio.to_thread(
-                    client.models.generate_content,
-                    model=MODEL_NAME,
-                    contents=input_data,
-                    config=COOK_GEN_CONFIG if cook_mode else None
-                )
-                break
-            except Exception as e:
-                msg = str(e).lower()
-                if "mimetype parameter" in msg and "not supported" in msg:
-                    if expect_type is None:
-                        return await message.edit_text("<code>Invalid file type. Please try again.</code>")
-                    else:
-                        raise
-                if any(x in msg for x in ("403", "429", "permission", "quota")):
-                    await asyncio.sleep(2)
-                else:
-                    raise
-        else:
-            raise e
+    labels = {"command": command, "kind": _media_kind(largest), "model": model}
+    job_started = time.monotonic()
 
-        text_out = getattr(response, "text", None)
-        if not text_out:
-            try:
-                text_out = response.candidates[0].content[0].text
-            except Exception:
-                text_out = None
+    async def run():
+        _job_labels.set(labels)
+        async with scheduler.slot(_media_kind(largest), size, message.chat.id, show_position) as was_queued:
+            _record_phase(labels, "queue", time.monotonic() - job_started)
+            if was_queued:
+                await message.edit_text(f"<code>{status_msg}</code>")
+            started = time.monotonic()
+            with key_pool.lease():
+                text_out = await _run_ai_job(message, reply, prompt, show_prompt, config, expect_type, flags, status_msg, model, batch, app)
+            if text_out:
+                route_latency[(route, model)].append(time.monotonic() - started)
+        _record_phase(labels, "total", time.monotonic() - job_started if text_out else None)
+        return text_out
+
+    job_id = str(next(_job_ids))
+    task = asyncio.ensure_future(run())
+    active_jobs[job_id] = {"task": task, "command": command, "kind": _media_kind(largest), "chat": message.chat.id, "started": job_started}
+    try:
+        text_out = await task
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            task.cancel()
+            raise
+        _record_phase(labels, "total", None)
+        return await message.edit_text(f"<code>Job {job_id} cancelled.</code>")
+    finally:
+        active_jobs.pop(job_id, None)
+    if answer_key and text_out:
+        _answer_store(answer_key, text_out)
 
-        result_text = (f"**Prompt:** {prompt}\n" if show_prompt else "") + f"**Answer:** {text_out or '<code>No content generated.</code>'}"
-        if len(result_text) > 4000:
-            for i in range(0, len(result_text), 4000):
-                await message.reply_text(result_text[i:i+4000], parse_mode=enums.ParseMode.MARKDOWN)
-            await message.delete()
+async def _run_ai_job(message, reply, prompt, show_prompt, config, expect_type, flags, status_msg, model, batch=None, app=None):
+    job = {"uploads": [], "files": [], "cached": [], "held": [], "flags": flags, "model": model, "app": app}
+    ensure_gc_worker()
+    try:
+        header = f"**Prompt:** {prompt}\n" if show_prompt else ""
+        if batch:
+            input_data = await _prepare_batch(batch, prompt, job)
+        elif _use_long_audio(reply, show_prompt, expect_type, flags):
+            text_out = await _transcribe_long(message, reply, prompt, status_msg, job)
+            await _deliver(message, header + f"**Answer:** {text_out or '<code>No content generated.</code>'}")
+            return text_out
+        elif _use_frames(reply, flags):
+            input_data = await _prepare_frames(reply, prompt, expect_type, job)
         else:
-            await message.edit_text(result_text, parse_mode=enums.ParseMode.MARKDOWN)
+            input_data = await prepare_input_data(reply, prompt, job)
+
+        if get_setting("preflight"):
+            tokens = await _input_tokens(model, input_data)
+            if tokens > int(get_setting("max_input_tokens")):
+                raise ValueError(f"Input is too large ({tokens} tokens, limit {get_setting('max_input_tokens')})")
+        streamed = get_setting("stream")
+        try:
+            if streamed:
+                with _phase("generate"):
+                    text_out = await _lease()["policy"].call(
+                        lambda: _stream_answer(message, header, model=job["model"], contents=input_data, config=config))
+            else:
+                text_out = _response_text(await _generate(model=job["model"], contents=input_data, config=config))
+                await _deliver(message, header + f"**Answer:** {text_out or '<code>No content generated.</code>'}")
+        except Exception as e:
+            if _classify(e) == "unsupported" and expect_type is None:
+                await message.edit_text("<code>Invalid file type. Please try again.</code>")
+                return None
+            raise
+        return text_out
+    except asyncio.CancelledError:
+        names, job["uploads"] = job["uploads"], []
+        await asyncio.gather(*(_delete_quietly(name) for name in names))
+        raise
     except ValueError as e:
         await message.edit_text(f"<code>{str(e)}</code>")
     except Exception as e:
+        for unique_id in job["cached"]:
+            _cache_drop(unique_id)
         await message.edit_text(f"<code>Error:</code> {format_exc(e)}")
     finally:
-        if uploaded_file:
-            try:
-                await asyncio.to_thread(client.files.delete, name=getattr(uploaded_file, "name", getattr(uploaded_file, "id", None)))
-            except Exception:
-                pass
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception:
-                pass
+        _release_uploads(job)
+        for name in job["uploads"]:
+            queue_delete(name)
+        for file_path in job["files"]:
+            if os.path.exists(file_path):
+                try:
+                    os.remove(file_path)
+                except Exception:
+                    pass
 
 @Client.on_message(filters.command("getai", prefix) & filters.me)
-async def getai(_, message):
-    prompt = (
-        message.text.split(maxsplit=1)[1]
-        if len(message.command) > 1
-        else "Get details of the image, be accurate as much possible, write short response."
-    )
+async def getai(app, message):
+    text, flags = _split_flags(message)
+    prompt = text or GETAI_PROMPT
     await ai_process_handler(
-        message, prompt, show_prompt=len(message.command) > 1,
-        expect_type="image", status_msg="Scanning...")
+        message, prompt, show_prompt=bool(text),
+        expect_type="image", status_msg="Scanning...", flags=flags, app=app)
 
 @Client.on_message(filters.command("aicook", prefix) & filters.me)
 async def aicook(_, message):
+    _, flags = _split_flags(message)
     await ai_process_handler(
         message,
         "Identify the baked good in the image and provide an accurate recipe.",
-        cook_mode=True, expect_type="image", status_msg="Cooking...")
+        cook_mode=True, expect_type="image", status_msg="Cooking...", flags=flags)
 
 @Client.on_message(filters.command("aiseller", prefix) & filters.me)
 async def aiseller(_, message):
-    if len(message.command) > 1:
-        target_audience = message.text.split(maxsplit=1)[1]
+    target_audience, flags = _split_flags(message)
+    if target_audience:
         prompt = f"Generate a marketing description for the product.\nTarget Audience: {target_audience}"
-        await ai_process_handler(message, prompt, expect_type="image", status_msg="Generating description...")
+        await ai_process_handler(message, prompt, expect_type="image", status_msg="Generating description...", flags=flags)
     else:
         await message.edit_text(
             f"<b>Usage:</b> <code>{prefix}aiseller [target audience]</code> [Reply to a product image]"
@@ -164,26 +1799,120 @@ async def aiseller(_, message):
 
 @Client.on_message(filters.command(["transcribe", "ts"], prefix) & filters.me)
 async def transcribe(_, message):
-    prompt = (
-        message.text.split(maxsplit=1)[1]
-        if len(message.command) > 1
-        else "Transcribe it. write only transcription text."
-    )
+    text, flags = _split_flags(message)
+    prompt = text or "Transcribe it. write only transcription text."
     await ai_process_handler(
-        message, prompt, show_prompt=len(message.command) > 1,
-        expect_type="audio", status_msg="Transcribing...")
+        message, prompt, show_prompt=bool(text),
+        expect_type="audio", status_msg="Transcribing...", flags=flags)
 
 @Client.on_message(filters.command(["process", "pr"], prefix) & filters.me)
-async def pr_command(_, message):
-    args = message.text.split(maxsplit=1)
-    show_prompt = len(args) > 1
-    prompt = args[1] if show_prompt else "Shortly summarize the content of file details of the file."
-    await ai_process_handler(message, prompt, show_prompt=show_prompt)
+async def pr_command(app, message):
+    text, flags = _split_flags(message)
+    count = 0
+    match = re.search(r"(?<!\S)--range\s+(\d+)(?!\S)", text)
+    if match:
+        count = int(match.group(1))
+        text = (text[:match.start()] + text[match.end():]).strip()
+    prompt = text or "Shortly summarize the content of file details of the file."
+    batch = await _collect_batch(app, message, count)
+    await ai_process_handler(message, prompt, show_prompt=bool(text), flags=flags, batch=batch, app=app)
+
+@Client.on_message(filters.command("airoute", prefix) & filters.me)
+async def airoute(_, message):
+    args = message.text.split()[1:]
+    routes = list(get_routes())
+    try:
+        if args[:1] == ["add"] and len(args) > 1:
+            routes.append(_parse_route(args[1:]))
+            db.set(NS, "routes", routes)
+        elif args[:1] == ["del"] and len(args) == 2:
+            index = int(args[1])
+            if index < 1:
+                raise IndexError(f"no rule #{index}")
+            routes.pop(index - 1)
+            db.set(NS, "routes", routes)
+        elif args[:1] == ["reset"]:
+            db.set(NS, "routes", None)
+            routes = list(DEFAULT_ROUTES)
+    except (ValueError, IndexError) as e:
+        return await message.edit_text(f"<code>Invalid route: {e}</code>")
+
+    lines = []
+    for label, rule in [(f"#{i}", rule) for i, rule in enumerate(routes, 1)] + [("default", {"model": get_setting("model")})]:
+        fields = " ".join(f"{k}={','.join(v) if isinstance(v, list) else v}" for k, v in rule.items() if k != "model")
+        samples = route_latency.get((label, rule["model"]), ())
+        latency = f"{len(samples)} runs, p50 {_median(samples):.1f}s" if samples else "no runs"
+        lines.append(f"{label} {rule['model']} {fields} ({latency})".replace("  ", " "))
+    await message.edit_text("<b>Model routes:</b>\n<code>" + "\n".join(lines) + "</code>")
+
+@Client.on_message(filters.command("aistats", prefix) & filters.me)
+async def aistats(_, message):
+    args = message.text.split()[1:]
+    if args[:1] == ["reset"]:
+        phase_stats.clear()
+        return await message.edit_text("<code>AI stats cleared.</code>")
+    dimension = args[0] if args and args[0] in STAT_DIMENSIONS else "command"
+    blocks = []
+    for value, phases in sorted(phase_stats[dimension].items()):
+        lines = [f"{value}:"]
+        for name in PHASES:
+            stats = phases.get(name)
+            if not stats:
+                continue
+            ordered = sorted(stats["samples"])
+            timings = (
+                f"n={len(ordered)} p50={_percentile(ordered, 0.5):.2f}s "
+                f"p95={_percentile(ordered, 0.95):.2f}s p99={_percentile(ordered, 0.99):.2f}s"
+                if ordered else "n=0"
+            )
+            lines.append(f"  {name:<8} {timings} err={stats['errors']}")
+        blocks.append("\n".join(lines))
+    body = "\n\n".join(blocks) or "No AI jobs recorded yet."
+    await message.edit_text(f"<b>AI phase latency by {dimension}:</b>\n<code>{body}</code>")
+
+@Client.on_message(filters.command("aicancel", prefix) & filters.me)
+async def aicancel(_, message):
+    args = message.text.split()[1:]
+    if not args:
+        now = time.monotonic()
+        lines = [
+            f"{job_id}: {entry['command']} {entry['kind']} {now - entry['started']:.0f}s"
+            for job_id, entry in active_jobs.items()
+        ]
+        body = "\n".join(lines) or "No AI jobs running."
+        return await message.edit_text(f"<b>Active AI jobs:</b>\n<code>{body}</code>")
+    targets = list(active_jobs) if args[0] == "all" else [args[0]]
+    cancelled = [job_id for job_id in targets if job_id in active_jobs and active_jobs[job_id]["task"].cancel()]
+    if not cancelled:
+        return await message.edit_text(f"<code>No running job {args[0]}.</code>")
+    await message.edit_text(f"<code>Cancelled job(s): {', '.join(cancelled)}</code>")
+
+@Client.on_message(filters.command("aiconf", prefix) & filters.me)
+async def aiconf(_, message):
+    args = message.text.split(maxsplit=2)
+    if len(args) == 3 and args[1] in DEFAULT_SETTINGS:
+        try:
+            value = set_setting(args[1], args[2])
+        except ValueError:
+            return await message.edit_text(f"<code>Invalid value for {args[1]}</code>")
+        return await message.edit_text(f"<code>{args[1]} = {value}</code>")
+    lines = "\n".join(f"{key} = {get_setting(key)}" for key in DEFAULT_SETTINGS)
+    stats = db.get(NS, "answer_cache_stats", {}) or {}
+    await message.edit_text(
+        f"<b>AI settings:</b>\n<code>{lines}</code>\n"
+        f"<b>Answer cache:</b> <code>{stats.get('hits', 0)} hits, {stats.get('misses', 0)} misses</code>"
+    )
 
 modules_help["generative"] = {
-    "getai [custom prompt] [reply to image]*": "Analyze an image using AI.",
+    "getai [custom prompt] [--detail] [--full] [reply to image]*": "Analyze an image using AI. Uses a small preview size unless --detail is given or the question needs detail; --full sends the untouched original.",
     "aicook [reply to image]*": "Identify food and generate cooking instructions.",
     "aiseller [target audience] [reply to image]*": "Generate marketing descriptions for products.",
-    "transcribe [custom prompt] [reply to audio/video]*": "Transcribe or summarize an audio or video file.",
-    "process [prompt] [reply to any file]*": "Process any file (image, audio, video, PDF, document, code, etc).",
+    "transcribe [custom prompt] [--long] [--frames] [reply to audio/video]*": "Transcribe or summarize an audio or video file. Long recordings (or --long) are split at silences and transcribed in parallel.",
+    "process [prompt] [--frames] [--quick] [--range N] [reply to any file]*": "Process any file (image, audio, video, PDF, document, code, etc). Replying to an album, or --range N for the next N messages, answers over all files at once. --frames sends sampled keyframes of a video instead of the whole file; --quick sends only its thumbnail.",
+    "airoute [add model field=value ... | del N | reset]": "Show or edit the model routing table with per-route latency. Fields: commands, kinds, min/max_duration, min/max_size, max_prompt.",
+    "aistats [command|kind|model|reset]": "Show p50/p95/p99 latency and error counts per phase (queue, download, stream, upload, poll, generate, send).",
+    "aicancel [id|all]": "List running AI jobs, or cancel one (or all). Cancelling stops the current step, deletes its uploads and frees the slot.",
+    "aiconf [key] [value]": "Show or change AI settings (engine, max_concurrency, max_video_jobs, upload_cache, ...). Add --nocache to any command to skip stored answers.",
 }
+
+schedule_warm_up()